@@ -5,100 +5,172 @@
 from __future__ import annotations
 
 import argparse
-import inspect
+import contextlib
+import functools
+import hashlib
+import json
 import logging
+import math
 import os
 import shutil
+import stat
 import subprocess
 import sys
+import tempfile
 import time
-from collections.abc import Sequence
+from collections.abc import Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import path
+from typing import NamedTuple
 
-global PCT_BIN
-global PVEAM_BIN
 CI_ENV_PREFIX = "CUSTOM_ENV_"
+PROVISIONING_SCRIPT = path.join(path.dirname(path.abspath(__file__)), "provisioning.sh")
+PUSH_STATE_DIR = "/run/proxmox-lxc-executor"
+
+
+def _ci_env() -> dict[str, str]:
+    """Returns the CI job variables passed by the runner.
+
+    The runner exposes job variables with the ``CUSTOM_ENV_`` prefix,
+    which is stripped from the returned names.
+    """
+    offset = len(CI_ENV_PREFIX)
+    return {k[offset:]: v for k, v in os.environ.items() if k.startswith(CI_ENV_PREFIX)}
+
+
+@functools.lru_cache(maxsize=None)
+def _pct() -> str | None:
+    """Returns the path to the pct tool.
+
+    The ``PCT_BIN`` environment variable takes precedence over a lookup
+    in ``$PATH``.
+    """
+    return os.environ.get("PCT_BIN") or shutil.which("pct")
+
+
+@functools.lru_cache(maxsize=None)
+def _pveam() -> str | None:
+    """Returns the path to the pveam tool.
+
+    The ``PVEAM_BIN`` environment variable takes precedence over a
+    lookup in ``$PATH``.
+    """
+    return os.environ.get("PVEAM_BIN") or shutil.which("pveam")
+
+
+def _table_rows(cmd: list[str]) -> Iterator[bytes]:
+    """Yields the undecoded rows of a command's table, without header."""
+    with subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE) as proc:
+        next(proc.stdout, None)
+        yield from proc.stdout
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def _run_quiet(cmd: list[str]):
+    """Runs a command, discarding its output unless it fails."""
+    try:
+        subprocess.run(
+            cmd,
+            shell=False,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+    except subprocess.CalledProcessError as e:
+        logging.error(f"{cmd[0]} failed: {e.stderr.strip()}")
+        raise
 
 
 def list_local_images(storage: str) -> list[str]:
-    storage_list: str = subprocess.check_output(
-        [PVEAM_BIN, "list", storage], encoding="utf8", text=True
-    )
-    images: list[str] = storage_list.splitlines()[1:]
-    images = [line.split()[0] for line in images]
+    images: list[str] = []
+    for line in _table_rows([_pveam(), "list", storage]):
+        images.append(line.split(None, 1)[0].decode())
     return images
 
 
 def list_online_images(section="system") -> list[str]:
-    storage_list: str = subprocess.check_output(
-        [PVEAM_BIN, "available", "--section", section], encoding="utf8", text=True
-    )
-    images: list[str] = storage_list.splitlines()[1:]
-    images = [line.split()[1] for line in images]
+    images: list[str] = []
+    for line in _table_rows([_pveam(), "available", "--section", section]):
+        images.append(line.split(None, 2)[1].decode())
     return images
 
 
 def download_image(storage: str, template: str) -> str:
     subprocess.check_call(
-        [PVEAM_BIN, "download", storage, template],
+        [_pveam(), "download", storage, template],
         shell=False,
     )
     return f"{storage}:vztmpl/{template}"
 
 
-def lxc_exists(container_id: int) -> bool:
+def _pct_status(container_id: int) -> str | None:
+    """Returns the status of a container.
+
+    Returns None if the container does not exist or ``pct status``
+    printed no status.
+    """
     try:
-        subprocess.check_call(
-            [PCT_BIN, "status", str(container_id)],
+        out: bytes = subprocess.check_output(
+            [_pct(), "status", str(container_id)],
             shell=False,
-            stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
         )
-        return True
     except subprocess.CalledProcessError:
-        return False
+        return None
+    parts = out.split()
+    return parts[-1].decode() if parts else None
+
+
+def ensure_image(storage: str, image: str, image_path: str = "vztmpl") -> str:
+    """Downloads an image unless it is already available locally.
+
+    :param str storage: Storage where to find/download the image
+    :param str image: Name of the image
+    :param str image_path: Path to the image
+    :return: Volume ID of the image
+    """
+    volume = f"{storage}:{image_path}/{image}"
+    if volume not in list_local_images(storage):
+        download_image(storage, image)
+    return volume
+
+
+def lxc_exists(container_id: int) -> bool:
+    return _pct_status(container_id) is not None
 
 
 def lxc_running(container_id: int) -> bool:
-    out: str = subprocess.check_output(
-        [PCT_BIN, "status", str(container_id)], shell=False, encoding="utf8"
-    )
-    status = out.strip().split()[-1]
-    return status == "running"
+    return _pct_status(container_id) == "running"
 
 
-def lxc_exists_and_running(container_id: int) -> bool:
-    try:
-        out: str = subprocess.check_output(
-            [PCT_BIN, "status", str(container_id)], shell=False, encoding="utf8"
-        )
-        status = out.split(" ")[1]
-        return status == "running"
-    except subprocess.CalledProcessError:
-        return False
+lxc_exists_and_running = lxc_running
 
 
-def list_lxc() -> list[dict[str, str]]:
-    output = subprocess.check_output(
-        [PCT_BIN, "list"], shell=False, encoding="utf8", text=True
-    )
-    lines = output.splitlines()[1:]
+class Container(NamedTuple):
+    """A row of the ``pct list`` output."""
+
+    id: int
+    status: str
+    name: str
+    lock: str | None = None
+
 
+def list_lxc() -> list[Container]:
     containers = []
-    for line in lines:
-        parts = line.split()
-        container = {}
+    for line in _table_rows([_pct(), "list"]):
+        parts = line.rstrip().split(None, 3)
         if len(parts) == 3:
-            container["id"] = parts[0]
-            container["status"] = parts[1]
-            container["name"] = parts[2]
+            container = Container(int(parts[0]), parts[1].decode(), parts[2].decode())
         elif len(parts) == 4:
-            container["id"] = parts[0]
-            container["status"] = parts[1]
-            container["lock"] = parts[2]
-            container["name"] = parts[3]
+            container = Container(
+                int(parts[0]), parts[1].decode(), parts[3].decode(), parts[2].decode()
+            )
         else:
-            raise Exception(f"Cannot read container information from line: {line}")
+            raise Exception(
+                f"Cannot read container information from line: {line.decode()}"
+            )
         containers.append(container)
     return containers
 
@@ -107,7 +179,7 @@ def isolate_service(container_id: int, service: str) -> bool:
     try:
         subprocess.check_call(
             [
-                PCT_BIN,
+                _pct(),
                 "exec",
                 str(container_id),
                 "--",
@@ -128,7 +200,7 @@ def is_active_service(container_id: int, service: str) -> bool:
     try:
         subprocess.check_call(
             [
-                PCT_BIN,
+                _pct(),
                 "exec",
                 str(container_id),
                 "--",
@@ -146,27 +218,114 @@ def is_active_service(container_id: int, service: str) -> bool:
         return False
 
 
-def destroy_all():
-    containers = list_lxc()
-    for container in containers:
-        if "lxc-runner" in container["name"]:
-            container_id = int(container["id"])
-            if lxc_running(container_id):
-                logging.info(f"Stopping container {container_id}")
-                subprocess.check_call([PCT_BIN, "stop", str(container_id)], shell=False)
-            subprocess.check_call([PCT_BIN, "destroy", str(container_id)], shell=False)
-
-
-def destroy(container_id: int) -> bool:
-    if not lxc_exists(container_id):
+def wait_system_running(container_id: int, timeout: float) -> bool:
+    """Waits until systemd inside the container has finished booting.
+
+    Blocks on ``systemctl is-system-running --wait`` under
+    ``timeout(1)`` inside the container. Returns False if the system is
+    degraded, the ``timeout`` binary is missing or the wait times out.
+    """
+    try:
+        subprocess.run(
+            [
+                _pct(),
+                "exec",
+                str(container_id),
+                "--",
+                "sh",
+                "-c",
+                # bound the wait inside the container as well, killing pct on
+                # the host does not necessarily end the attached process
+                "command -v timeout >/dev/null || exit 1; "
+                'exec timeout "$1" systemctl is-system-running --wait',
+                "sh",
+                str(math.ceil(timeout)),
+            ],
+            shell=False,
+            check=True,
+            timeout=timeout,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return True
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
         return False
 
-    if lxc_running(container_id):
-        logging.info(f"Stopping container {container_id}")
-        subprocess.check_call([PCT_BIN, "stop", str(container_id)], shell=False)
 
+def wait_active_service(container_id: int, service: str, timeout: float) -> bool:
+    """Waits until a service is active inside the container.
+
+    The polling happens inside the container, so only a single ``pct
+    exec`` is needed on the host. The loop inside the container stops
+    on its own after ``timeout`` seconds.
+    """
+    try:
+        subprocess.run(
+            [
+                _pct(),
+                "exec",
+                str(container_id),
+                "--",
+                "sh",
+                "-c",
+                "end=$(($(date +%s) + $2)); "
+                'until systemctl is-active --quiet "$1"; do '
+                '[ "$(date +%s)" -lt "$end" ] || exit 1; '
+                # fall back to whole seconds if sleep rejects fractions
+                "sleep 0.1 2>/dev/null || sleep 1 || exit 1; done",
+                "sh",
+                service,
+                str(math.ceil(timeout)),
+            ],
+            shell=False,
+            check=True,
+            timeout=timeout,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return True
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return False
+
+
+def destroy_all():
+    containers = [c for c in list_lxc() if "lxc-runner" in c.name]
+    if not containers:
+        return
+
+    # stopping a container may take a while, so clean them up concurrently
+    with ThreadPoolExecutor(max_workers=min(16, len(containers))) as executor:
+        futures = {
+            executor.submit(destroy, c.id, exists=True): c.id for c in containers
+        }
+        error: BaseException | None = None
+        for future in as_completed(futures):
+            e = future.exception()
+            if e is not None:
+                logging.error(f"Failed to destroy container {futures[future]}: {e}")
+                error = error or e
+
+    if error is not None:
+        raise error
+
+
+def destroy(container_id: int, exists: bool = False) -> bool:
+    """Stops and destroys a container.
+
+    :param int container_id: Container ID of the container to destroy
+    :param bool exists: The caller knows that the container exists, so
+        no ``pct status`` call is made to check it.
+    """
+    _clear_push_state(container_id)
+
+    if not exists and _pct_status(container_id) is None:
+        return False
+
+    # --force stops a running container as part of the destroy
     logging.info(f"Destroying container {container_id}")
-    subprocess.check_call([PCT_BIN, "destroy", str(container_id)], shell=False)
+    subprocess.check_call(
+        [_pct(), "destroy", str(container_id), "--force", "--purge"], shell=False
+    )
 
     return True
 
@@ -186,12 +345,19 @@ def create(
     mknod: bool = True,
     fuse: bool = True,
     unprivileged: bool = True,
+    volume: str | None = None,
+    ci: dict[str, str] | None = None,
 ):
     """Creates a new container from an image.
 
     If the image is not available locally this function tries to
     download the image.
 
+    :param str volume: Volume ID of the image as returned by
+        :func:`ensure_image`. When given, the image is not looked up
+        or downloaded again.
+    :param dict ci: CI job variables as returned by :func:`_ci_env`.
+        They are read from the environment if not given.
     :param bool unprivileged: Makes the container run as unprivileged
         user.
     :param bool nesting: Allow containers access to advanced features.
@@ -211,44 +377,34 @@ def create(
     :param str image: Container image to create the container from
     """
 
-    image_path = f"{storage}:{image_path}/{image}"
-    images = list_local_images(storage)
-    if image_path not in images:
-        download_image(storage, image)
+    if volume is None:
+        volume = ensure_image(storage, image, image_path=image_path)
 
     logging.info(f"Creating container {container_id}:")
 
     logging.info(f"       Image:       {image}")
 
     cmd = [
-        PCT_BIN,
+        _pct(),
         "create",
         str(container_id),
-        image_path,
+        volume,
         "--net0",
         "name=eth0,bridge=vmbr0,ip=dhcp",
     ]
 
     description = f"GitLab LXC Runner {container_id}\n"
-    if os.getenv(CI_ENV_PREFIX + "CI_PIPELINE_URL"):
-        description = (
-            description
-            + "[Project]("
-            + os.getenv(CI_ENV_PREFIX + "CI_PROJECT_URL")
-            + ")\n"
-        )
-    if os.getenv(CI_ENV_PREFIX + "CI_PIPELINE_URL"):
-        description = (
-            description
-            + "[Pipeline]("
-            + os.getenv(CI_ENV_PREFIX + "CI_PIPELINE_URL")
-            + ")\n"
-        )
-    if os.getenv("CI_MERGE_REQUEST_PROJECT_URL"):
+    if ci is None:
+        ci = _ci_env()
+    if ci.get("CI_PROJECT_URL"):
+        description = description + "[Project](" + ci["CI_PROJECT_URL"] + ")\n"
+    if ci.get("CI_PIPELINE_URL"):
+        description = description + "[Pipeline](" + ci["CI_PIPELINE_URL"] + ")\n"
+    if ci.get("CI_MERGE_REQUEST_PROJECT_URL"):
         description = (
             description
             + "[Merge request]("
-            + os.getenv("CI_MERGE_REQUEST_PROJECT_URL")
+            + ci["CI_MERGE_REQUEST_PROJECT_URL"]
             + ")\n"
         )
     cmd.append("--description")
@@ -295,12 +451,7 @@ def create(
     unprivileged = "1" if unprivileged else "0"
     cmd.append(unprivileged)
 
-    subprocess.run(
-        cmd,
-        shell=False,
-        capture_output=True,
-        text=True,
-    )
+    _run_quiet(cmd)
 
 
 def start(container_id: int, timeout: int) -> bool:
@@ -308,67 +459,185 @@ def start(container_id: int, timeout: int) -> bool:
 
     subprocess.check_call(
         [
-            PCT_BIN,
+            _pct(),
             "start",
             str(container_id),
         ],
         shell=False,
     )
 
-    for i in range(timeout):
-        if is_active_service(container_id, "multi-user.target"):
-            logging.debug(f"Container {container_id} started after {i} seconds")
-            return False
-        time.sleep(1)
+    started = time.monotonic()
+    deadline = started + timeout
+
+    # systemd blocks until the boot has finished, which saves us from polling
+    if wait_system_running(container_id, timeout):
+        logging.debug(
+            f"Container {container_id} started after "
+            f"{time.monotonic() - started:.2f} seconds"
+        )
+        return True
+
+    # fall back to waiting for the target, e.g. for a degraded system or an
+    # old systemd. Retry with a backoff if the container cannot be entered yet.
+    interval = 0.05
+    while time.monotonic() < deadline:
+        remaining = deadline - time.monotonic()
+        if wait_active_service(container_id, "multi-user.target", remaining):
+            logging.debug(
+                f"Container {container_id} started after "
+                f"{time.monotonic() - started:.2f} seconds"
+            )
+            return True
+        time.sleep(interval)
+        interval = min(interval * 1.5, 1.0)
 
     return False
 
 
-def provision(container_id: int):
-    logging.info(f"Provisioning container {container_id}")
+@functools.lru_cache(maxsize=None)
+def _provisioning_script() -> bytes:
+    """Returns the content of the provisioning script next to this file."""
+    with open(PROVISIONING_SCRIPT, "rb") as f:
+        return f.read()
 
-    local_directory = os.path.dirname(
-        os.path.abspath(inspect.getfile(inspect.currentframe()))
-    )
-    local_script = path.join(local_directory, "provisioning.sh")
 
-    remote_script = "/usr/local/bin/provisioning"
-    subprocess.check_call(
-        [
-            PCT_BIN,
-            "push",
-            str(container_id),
-            local_script,
-            remote_script,
-            "--perms",
-            "0755",
-            "--user",
-            "root",
-            "--group",
-            "root",
-        ],
-        shell=False,
-        text=True,
-    )
+def _script_shell(script: bytes) -> str | None:
+    """Returns the shell from the shebang of a script.
+
+    Only ``bash`` and ``sh`` without further arguments are recognized,
+    either as a path or through ``env``. Returns None for any other
+    interpreter.
+    """
+    if not script.startswith(b"#!"):
+        return None
+    args = script[2:].split(b"\n", 1)[0].split()
+    if args and path.basename(args[0]) == b"env":
+        args = args[1:]
+    if len(args) == 1 and path.basename(args[0]) in (b"bash", b"sh"):
+        return args[0].decode()
+    return None
+
+
+def _stream_command(
+    container_id: int, shell: str, name: str | None = None
+) -> list[str]:
+    """Returns a ``pct exec`` command that runs a script read from stdin.
+
+    The script is read completely before it is evaluated, so commands
+    in the script do not consume the remaining script from stdin.
+
+    :param int container_id: Container ID of the container
+    :param str shell: Shell to evaluate the script with
+    :param str name: Name of the script, passed to the shell as ``$0``
+    """
+    cmd = [_pct(), "exec", str(container_id), "--", shell, "-c", 'eval "$(cat)"']
+    if name is not None:
+        cmd.append(name)
+    return cmd
+
+
+def exec_script(container_id: int, script: bytes, shell: str = "bash"):
+    """Executes a script inside the container without copying it first.
+
+    The script is streamed to the shell over the stdin of ``pct exec``.
+    """
     subprocess.run(
-        [PCT_BIN, "exec", str(container_id), remote_script],
+        _stream_command(container_id, shell),
         shell=False,
         check=True,
+        input=script,
         stdout=sys.stdout,
         stderr=sys.stderr,
     )
 
 
-def run(container_id: int, script: str, stage: str):
-    logging.debug(f"run: {stage} {script}")
+def _push_state_dir() -> str | None:
+    """Returns the directory for the push state.
 
-    remote_path = path.join("/usr/local/bin", stage)
-    subprocess.run(
+    The directory must be private to the current user, otherwise other
+    users could forge the state and make :func:`push` skip a file.
+    Returns None if such a directory is not available.
+    """
+    try:
+        os.makedirs(PUSH_STATE_DIR, mode=0o700, exist_ok=True)
+        st = os.lstat(PUSH_STATE_DIR)
+    except OSError:
+        return None
+    if (
+        not stat.S_ISDIR(st.st_mode)
+        or st.st_uid != os.geteuid()
+        or st.st_mode & (stat.S_IRWXG | stat.S_IRWXO)
+    ):
+        logging.warning(f"Not using {PUSH_STATE_DIR}, it is not private")
+        return None
+    return PUSH_STATE_DIR
+
+
+def _push_state_path(container_id: int) -> str:
+    return path.join(PUSH_STATE_DIR, f"{container_id}.json")
+
+
+def _clear_push_state(container_id: int):
+    """Removes the push state of a container.
+
+    Only containers that were used with ``run --persist`` have one.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(_push_state_path(container_id))
+
+
+def _file_digest(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _container_config_version(container_id: int) -> int | None:
+    """Returns the modification time of the container's config file.
+
+    A container that is recreated with the same ID gets a new config
+    file, so this changes even if the container was not destroyed by
+    :func:`destroy`.
+    """
+    try:
+        return os.stat(f"/etc/pve/lxc/{container_id}.conf").st_mtime_ns
+    except OSError:
+        return None
+
+
+def push(container_id: int, local_path: str, remote_path: str):
+    """Copies a file into the container.
+
+    The SHA-256 of every pushed file is remembered per container, so a
+    file that was already pushed with the same content is skipped. The
+    state is discarded when the container's config file changes, e.g.
+    because the container was recreated. Changes made to the pushed
+    file from inside the container are not detected.
+    """
+    state_dir = _push_state_dir()
+    state_path = _push_state_path(container_id)
+    version = _container_config_version(container_id)
+    state: dict[str, str] = {}
+    if state_dir is not None and version is not None:
+        with contextlib.suppress(OSError, ValueError, AttributeError):
+            with open(state_path) as f:
+                saved = json.load(f)
+            if saved.get("config") == version:
+                state = dict(saved.get("files", {}))
+
+    digest = _file_digest(local_path)
+    if state.get(remote_path) == digest:
+        logging.debug(f"{remote_path} is up to date in container {container_id}")
+        return
+
+    _run_quiet(
         [
-            PCT_BIN,
+            _pct(),
             "push",
             str(container_id),
-            script,
+            local_path,
             remote_path,
             "--perms",
             "0755",
@@ -377,15 +646,79 @@ def run(container_id: int, script: str, stage: str):
             "--group",
             "root",
         ],
-        shell=False,
-        capture_output=True,
     )
 
+    if state_dir is None or version is None:
+        return
+
+    # replace the state atomically so an interrupted write cannot corrupt it
+    state[remote_path] = digest
+    fd, tmp_path = tempfile.mkstemp(dir=state_dir)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"config": version, "files": state}, f)
+        os.replace(tmp_path, state_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def provision(container_id: int):
+    logging.info(f"Provisioning container {container_id}")
+    script = _provisioning_script()
+    exec_script(container_id, script, _script_shell(script) or "bash")
+
+
+def _replace_process(cmd: list[str], stdin: int | None = None):
+    """Replaces the current process with the given command.
+
+    :param list cmd: Command and arguments to execute
+    :param int stdin: File descriptor to use as stdin of the command
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if stdin is not None:
+        os.dup2(stdin, 0)
+    os.execvp(cmd[0], cmd)
+
+
+def run(container_id: int, script: str, stage: str, persist: bool = False):
+    """Runs a stage script inside the container.
+
+    The driver process is replaced by ``pct exec``, so this function
+    does not return and the exit code of the script becomes the exit
+    code of the driver.
+
+    :param int container_id: Container ID of the container
+    :param str script: Path to the script on the host
+    :param str stage: Name of the stage
+    :param bool persist: Copy the script to ``/usr/local/bin/<stage>``
+        inside the container before running it, instead of streaming
+        it. Scripts without a ``bash`` or ``sh`` shebang are always
+        copied, so their interpreter is picked by the shebang.
+    """
+    logging.debug(f"run: {stage} {script}")
+
+    remote_path = path.join("/usr/local/bin", stage)
+    fd = os.open(script, os.O_RDONLY)
+    # the kernel limits the shebang line to 256 bytes as well
+    shell = _script_shell(os.pread(fd, 256, 0))
+
+    if persist or shell is None:
+        push(container_id, script, remote_path)
+        cmd = [_pct(), "exec", str(container_id), remote_path]
+        stdin = None
+    else:
+        cmd = _stream_command(container_id, shell, name=remote_path)
+        stdin = fd
+
     logging.info(f"Running {stage} stage")
-    subprocess.check_call([PCT_BIN, "exec", str(container_id), remote_path])
+    _replace_process(cmd, stdin=stdin)
 
 
-def main(argv: Sequence[str] | None = None) -> int:
+@functools.lru_cache(maxsize=None)
+def _build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
     )
@@ -454,6 +787,11 @@ def main(argv: Sequence[str] | None = None) -> int:
         "script", help="Path to the script to run inside the container"
     )
     run_parser.add_argument("stage", help="Name of the stage")
+    run_parser.add_argument(
+        "--persist",
+        help="Copy the script into the container instead of streaming it",
+        action=argparse.BooleanOptionalAction,
+    )
 
     # cleanup options
     cleanup_parser = subparsers.add_parser(
@@ -465,29 +803,31 @@ def main(argv: Sequence[str] | None = None) -> int:
         action=argparse.BooleanOptionalAction,
     )
 
-    args: argparse.Namespace = parser.parse_args(argv)
+    return parser
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    args: argparse.Namespace = _build_parser().parse_args(argv)
 
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(message)s", level=logging.DEBUG
     )
 
-    global PCT_BIN
-    PCT_BIN = shutil.which("pct")
-    if not PCT_BIN:
+    if not _pct():
         logging.critical("Cannot find the pct tool!")
         return 3
 
-    global PVEAM_BIN
-    PVEAM_BIN = shutil.which("pveam")
-    if not PVEAM_BIN:
+    if not _pveam():
         logging.critical("Cannot find the pveam tool!")
         return 3
 
+    ci = _ci_env()
+
     # config container ID
     if args.id:
         container_id = args.id
-    elif os.getenv(CI_ENV_PREFIX + "CI_JOB_ID"):
-        container_id = os.getenv(CI_ENV_PREFIX + "CI_JOB_ID")
+    elif ci.get("CI_JOB_ID"):
+        container_id = ci.get("CI_JOB_ID")
     else:
         logging.critical(
             "You must either provide the --id flag or the CUSTOM_ENV_CI_JOB_ID environment variable!"
@@ -500,7 +840,7 @@ def main(argv: Sequence[str] | None = None) -> int:
 
     # command cleanup
     elif args.command == "cleanup":
-        skip = os.getenv(CI_ENV_PREFIX + "runner_skip_cleanup")
+        skip = ci.get("runner_skip_cleanup")
         if skip is not None and skip.lower() == "true":
             print("Skipping container cleanup")
         else:
@@ -512,42 +852,47 @@ def main(argv: Sequence[str] | None = None) -> int:
         storage = "local"
         if args.storage:
             storage = args.storage
-        elif not args.no_image_env and os.getenv(CI_ENV_PREFIX + "runner_storage"):
-            storage = os.getenv(CI_ENV_PREFIX + "runner_storage")
+        elif not args.no_image_env and ci.get("runner_storage"):
+            storage = ci.get("runner_storage")
 
         # config image
         if args.image:
             image = args.image
-        elif not args.no_image_env and os.getenv(CI_ENV_PREFIX + "CI_JOB_IMAGE"):
-            image = os.getenv(CI_ENV_PREFIX + "CI_JOB_IMAGE")
+        elif not args.no_image_env and ci.get("CI_JOB_IMAGE"):
+            image = ci.get("CI_JOB_IMAGE")
         else:
             image = "ubuntu-22.04-standard_22.04-1_amd64.tar.zst"
 
         # config cores
         if args.cores:
             cores = args.cores
-        elif os.getenv(CI_ENV_PREFIX + "runner_cores"):
-            cores = os.getenv(CI_ENV_PREFIX + "runner_cores")
+        elif ci.get("runner_cores"):
+            cores = ci.get("runner_cores")
         else:
             cores = None
 
         # config memory
         if args.memory:
             memory = args.memory
-        elif os.getenv(CI_ENV_PREFIX + "runner_memory"):
-            memory = os.getenv(CI_ENV_PREFIX + "runner_memory")
+        elif ci.get("runner_memory"):
+            memory = ci.get("runner_memory")
         else:
             memory = None
 
         # config password
         if args.password:
             password = args.memory
-        elif os.getenv(CI_ENV_PREFIX + "runner_password"):
-            password = os.getenv(CI_ENV_PREFIX + "runner_password")
+        elif ci.get("runner_password"):
+            password = ci.get("runner_password")
         else:
             password = None
 
-        destroy(container_id)
+        # download the image while an old container is being removed
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            image_download = executor.submit(ensure_image, storage, image)
+            destroy(container_id)
+            volume = image_download.result()
+
         create(
             container_id,
             image,
@@ -556,15 +901,19 @@ def main(argv: Sequence[str] | None = None) -> int:
             cores=cores,
             memory=memory,
             password=password,
+            volume=volume,
+            ci=ci,
         )
-        start(container_id, 60)
+        if not start(container_id, 60):
+            logging.critical(f"Container {container_id} did not start in time!")
+            return 4
         provision(container_id)
 
     # command run
     elif args.command == "run":
         script = args.script
         stage = args.stage
-        run(container_id, script, stage)
+        run(container_id, script, stage, persist=args.persist)
 
     else:
         logging.error(f"Unknown command:  {args.command}")